@@ -1,26 +1,80 @@
 import os
 import re
-import math
 import logging
+import shutil
 import subprocess
+import tempfile
 import json
 import time
 import asyncio
-from typing import Optional, List
+import errno
+import mmap
+import stat
+import struct
+from collections import deque
+from contextlib import aclosing
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncGenerator, Callable, Optional, List, Union
 
-from aiogram import Bot, Dispatcher, types
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import aiofiles
+from aiohttp import web
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.enums import ParseMode
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
 
 # Настройки
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
-MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024  # 2 ГБ
-CHUNK_SIZE = 1.9 * 1024 * 1024 * 1024  # 1.9 ГБ для безопасности
-DOWNLOAD_DIR = "downloads"
+MAX_FILE_SIZE = 2000 * 1024 * 1024  # Лимит локального Bot API сервера — 2000 МБ, а не 2 ГиБ
+# ~1.9 ГБ для безопасности; кратно 1 МБ, чтобы границы частей совпадали с блоками ФС (нужно для reflink)
+CHUNK_SIZE = 1945 * 1024 * 1024
+# По умолчанию — отдельный временный каталог (часто tmpfs или быстрый локальный диск)
+DOWNLOAD_DIR = os.getenv('DOWNLOAD_DIR') or tempfile.mkdtemp(prefix='ytbot_')
+# Одновременная отправка частей; 1 — строго по порядку
+MAX_PARALLEL_UPLOADS = max(1, int(os.getenv('MAX_PARALLEL_UPLOADS', 4)))
+# Одновременные отправки в один чат по всем его запросам; если меньше
+# MAX_PARALLEL_UPLOADS, действует именно этот лимит
+MAX_UPLOADS_PER_CHAT = max(1, int(os.getenv('MAX_UPLOADS_PER_CHAT', MAX_PARALLEL_UPLOADS)))
+SPLIT_WORKERS = 4  # Параллельное копирование частей при разделении
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Размер блока чтения файла при отправке в Telegram
+# Таймаут отправки видео, секунды: стандартных 60 секунд сессии не хватает на гигабайты
+UPLOAD_TIMEOUT = int(os.getenv('UPLOAD_TIMEOUT', 3600))
+YTDLP_WORKERS = max(1, int(os.getenv('MAX_CONCURRENT_DL', 4)))  # Одновременные загрузки yt-dlp
+# Фрагменты, скачиваемые одним yt-dlp параллельно (обход ограничения скорости на соединение);
+# для YouTube работает благодаря youtube:formats=dashy в YTDLP_COMMON_ARGS
+YTDLP_FRAGMENTS = max(1, int(os.getenv('YTDLP_FRAGMENTS', 8)))
+# Запас места под загрузку: дорожки до склейки, итоговый файл и его части
+DISK_HEADROOM = 2.2
+# Локальный Bot API сервер снимает лимит облачного API на размер загружаемых файлов
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+# Сервер видит те же файлы: они передаются путём, без загрузки по HTTP
+TELEGRAM_API_LOCAL = os.getenv('TELEGRAM_API_LOCAL', '').lower() in ('1', 'true', 'yes')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Если не задан, бот работает через polling
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token: без него любой, кто знает путь,
+# может присылать поддельные обновления (допустимы символы A-Z, a-z, 0-9, _ и -)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+PORT = int(os.getenv('PORT', 8080))
+ALLOWED_UPDATES = ["message", "callback_query"]  # Типы обновлений, которые обрабатывает бот
+# Общее хранилище состояний для нескольких процессов бота (нужен пакет redis
+# и общий для всех процессов DOWNLOAD_DIR); без него состояния хранятся в памяти
+REDIS_URL = os.getenv('REDIS_URL')
+FSM_TTL = 24 * 60 * 60  # Срок хранения состояния в Redis, секунды
 
 # Настройка логирования
 logging.basicConfig(
@@ -33,68 +87,256 @@ logger = logging.getLogger(__name__)
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
 # Инициализация бота и диспетчера
-storage = MemoryStorage()
-bot = Bot(token=TELEGRAM_TOKEN)
+if REDIS_URL:
+    from aiogram.fsm.storage.redis import RedisStorage
+    storage = RedisStorage.from_url(REDIS_URL, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+else:
+    storage = MemoryStorage()
+# Одна сессия с пулом соединений на весь процесс
+session = AiohttpSession(limit=100)
+if TELEGRAM_API_URL:
+    session.api = TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=TELEGRAM_API_LOCAL)
+session._connector_init.update(limit_per_host=30, ttl_dns_cache=300, keepalive_timeout=75)
+bot = Bot(token=TELEGRAM_TOKEN, session=session)
 dp = Dispatcher(storage=storage)
 
+# Ограничение числа одновременно работающих процессов yt-dlp
+_download_slots = asyncio.Semaphore(YTDLP_WORKERS)
+
 # Состояния для FSM
 class VideoStates(StatesGroup):
     waiting_for_url = State()
     waiting_for_split = State()
+    splitting = State()
 
 # Лимитер запросов
 class TelegramRateLimiter:
+    """Лимиты Telegram: ~30 сообщений в секунду на бота, 1 в секунду на личный чат, 20 в минуту на группу"""
+
     def __init__(self):
-        self.message_count = 0
-        self.last_minute = int(time.time() // 60)
-        self.messages_per_minute = 0
-        
-    async def wait_if_needed(self):
-        current_minute = int(time.time() // 60)
-        if current_minute > self.last_minute:
-            self.messages_per_minute = 0
-            self.last_minute = current_minute
-        self.message_count += 1
-        self.messages_per_minute += 1
-        if self.messages_per_minute >= 1200:
-            wait_time = 60 - (time.time() % 60)
-            logger.info(f"Достигнут лимит сообщений в минуту. Ожидание {wait_time:.1f} секунд...")
-            await asyncio.sleep(wait_time)
-            self.messages_per_minute = 0
-            self.last_minute = int(time.time() // 60)
-        elif self.message_count % 20 == 0:
-            await asyncio.sleep(1)
-        elif self.message_count % 5 == 0:
-            await asyncio.sleep(0.2)
+        self._global = AsyncLimiter(max_rate=30, time_period=1)
+        # Записи чатов живут, пока чат активен: срок продлевается при каждом обращении.
+        # Срок слотов больше UPLOAD_TIMEOUT, чтобы занятый семафор не пропал посреди отправки
+        self._per_chat = TTLCache(maxsize=10000, ttl=3600)
+        self._chat_slots = TTLCache(maxsize=10000, ttl=UPLOAD_TIMEOUT + 600)
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float):
+        """Остановка всех отправок на время, указанное Telegram в RetryAfter"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def chat_slots(self, chat_id: int) -> asyncio.Semaphore:
+        """Ограничение числа одновременных отправок в один чат, независимо от темпа"""
+        slots = self._chat_slots.get(chat_id)
+        if slots is None:
+            slots = asyncio.Semaphore(MAX_UPLOADS_PER_CHAT)
+        self._chat_slots[chat_id] = slots
+        return slots
+
+    async def acquire(self, chat_id: int):
+        """Ожидание свободного слота в глобальном и чатовом лимитах"""
+        chat_limiter = self._per_chat.get(chat_id)
+        if chat_limiter is None:
+            # Отрицательный ID — группа или канал
+            chat_limiter = AsyncLimiter(20, 60) if chat_id < 0 else AsyncLimiter(1, 1)
+        self._per_chat[chat_id] = chat_limiter
+        # Сначала чатовый лимит, чтобы ожидание в одном чате не расходовало общий
+        async with chat_limiter:
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with self._global:
+                pass
 
 rate_limiter = TelegramRateLimiter()
 
+# Кэш информации о видео: ID -> результат yt-dlp --dump-json
+_info_cache = TTLCache(maxsize=256, ttl=600)
+_info_locks: dict[str, asyncio.Lock] = {}
+_INFO_UNUSED_KEYS = ("automatic_captions", "subtitles", "thumbnails", "heatmap")
+
+class RetryAfterMiddleware(BaseRequestMiddleware):
+    """Повтор любого запроса к Bot API после TelegramRetryAfter с паузой всех отправок"""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        while True:
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                logger.warning(f"Превышен лимит Telegram. Повтор через {e.retry_after} секунд...")
+                rate_limiter.pause(e.retry_after)
+                await asyncio.sleep(e.retry_after + 0.1)
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Соблюдение лимитов Telegram для каждого запроса в чат, в том числе повторного"""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        # getUpdates, answerCallbackQuery и прочие запросы без чата не ограничиваются;
+        # @username каналов лимитируется только на стороне Telegram
+        if isinstance(chat_id, int):
+            await rate_limiter.acquire(chat_id)
+        return await make_request(bot, method)
+
+# Порядок важен: повтор после RetryAfter снова проходит через лимитер
+session.middleware(RetryAfterMiddleware())
+session.middleware(RateLimitMiddleware())
+
+# Последний текст статусных сообщений: (чат, сообщение) -> текст
+_last_edits = TTLCache(maxsize=1024, ttl=3600)
+
+async def _edit_message(chat_id: int, message_id: int, text: str,
+                        reply_markup: Optional[InlineKeyboardMarkup] = None):
+    """Правка сообщения; тот же текст повторно не отправляется"""
+    key = (chat_id, message_id)
+    if reply_markup is None and _last_edits.get(key) == text:
+        return
+    await bot.edit_message_text(
+        chat_id=chat_id,
+        message_id=message_id,
+        text=text,
+        reply_markup=reply_markup,
+        parse_mode=ParseMode.MARKDOWN_V2
+    )
+    if reply_markup is None:
+        _last_edits[key] = text
+    else:
+        _last_edits.pop(key, None)
+
+class EditCoalescer:
+    """Промежуточные правки сообщений: ожидающий текст заменяется более новым,
+    а отправка идёт не чаще раза в min_interval секунд"""
+
+    def __init__(self, min_interval: float = 1.5):
+        self._min_interval = min_interval
+        self._pending: dict[tuple[int, int], str] = {}
+        self._tasks: dict[tuple[int, int], asyncio.Task] = {}
+
+    def edit(self, chat_id: int, message_id: int, text: str):
+        """Запланировать правку; ещё не отправленный текст отбрасывается"""
+        key = (chat_id, message_id)
+        self._pending[key] = text
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._run(key))
+
+    def discard(self, chat_id: int, message_id: int):
+        """Отмена ожидающих правок сообщения"""
+        key = (chat_id, message_id)
+        self._pending.pop(key, None)
+        task = self._tasks.pop(key, None)
+        if task:
+            task.cancel()
+
+    async def _run(self, key: tuple[int, int]):
+        try:
+            while (text := self._pending.pop(key, None)) is not None:
+                try:
+                    await _edit_message(*key, text)
+                except TelegramBadRequest as e:
+                    if "message is not modified" not in str(e):
+                        logger.error(f"Ошибка правки сообщения: {e}")
+                except Exception as e:
+                    logger.error(f"Ошибка правки сообщения: {e}")
+                await asyncio.sleep(self._min_interval)
+        finally:
+            if self._tasks.get(key) is asyncio.current_task():
+                del self._tasks[key]
+
+edit_coalescer = EditCoalescer()
+
+async def edit_status(chat_id: int, message_id: int, text: str,
+                      reply_markup: Optional[InlineKeyboardMarkup] = None):
+    """Немедленная правка статусного сообщения; отложенные правки прогресса отменяются"""
+    edit_coalescer.discard(chat_id, message_id)
+    await _edit_message(chat_id, message_id, text, reply_markup)
+
+# Результат успешной проверки зависимостей; неудача не кэшируется,
+# чтобы исправленный PATH подхватывался без перезапуска
+_deps_ok: Optional[bool] = None
+
+def invalidate_deps_cache():
+    """Сброс кэша проверки зависимостей"""
+    global _deps_ok
+    _deps_ok = None
+
 def check_dependencies() -> bool:
-    """Проверка наличия yt-dlp и ffmpeg"""
+    """Проверка наличия yt-dlp и ffmpeg (после первого успеха — без запуска процессов)"""
+    global _deps_ok
+    if _deps_ok is not None:
+        return _deps_ok
     try:
         subprocess.run(["yt-dlp", "--version"], capture_output=True, check=True)
         subprocess.run(["ffmpeg", "-version"], capture_output=True, check=True)
+        _deps_ok = True
         return True
     except (subprocess.CalledProcessError, FileNotFoundError) as e:
         logger.error(f"Ошибка зависимостей: {e}. Убедитесь, что yt-dlp и ffmpeg установлены и добавлены в PATH.")
         return False
 
+_ESCAPE_TABLE = str.maketrans({char: '\\' + char for char in r'_*[]()~`>#+-=|{}.!'})
+
 def escape_markdown_v2(text: str) -> str:
     """Экранирование зарезервированных символов для MarkdownV2"""
     if not isinstance(text, str):
         text = str(text)
-    reserved_chars = r'_*[]()~`>#+-=|{}.!'
-    return ''.join(f'\\{char}' if char in reserved_chars else char for char in text)
+    return text.translate(_ESCAPE_TABLE)
+
+def markdown_v2_bold(text: str) -> str:
+    """Экранирование текста с сохранением *жирной* разметки (в тексте нет буквальных звёздочек)"""
+    return escape_markdown_v2(text).replace('\\*', '*')
+
+# Тексты команд, кнопки выбора и их разметка готовятся один раз при загрузке модуля
+_WELCOME_TEXT = markdown_v2_bold(
+    "🎬 *YouTube Downloader Bot*\n\n"
+    "📋 *Возможности:*\n"
+    "• Скачивание видео в 1080p–2K качестве\n"
+    "• Поддержка длинных видео (2+ часа)\n"
+    "• Автоматическое разделение больших файлов\n\n"
+    "📝 *Как использовать:*\n"
+    "Отправьте ссылку на YouTube видео или используйте команды:\n"
+    "/start - Начать работу\n"
+    "/help - Показать справку"
+)
+
+_HELP_TEXT = markdown_v2_bold(
+    "🆘 *Помощь*\n\n"
+    "*Команды:*\n"
+    "/start - Запуск бота\n"
+    "/help - Эта справка\n\n"
+    "*Как скачать видео:*\n"
+    "Отправьте ссылку на YouTube видео. Видео будет загружено в 1080p–2K качестве. Если размер превысит 2 ГБ, бот предложит разделить файл.\n\n"
+    "*Поддерживаемые форматы ссылок:*\n"
+    "• youtube.com/watch?v=...\n"
+    "• youtu.be/...\n"
+    "• m.youtube.com/..."
+)
+
+_SPLIT_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="✅ Разделить", callback_data="split"),
+        InlineKeyboardButton(text="❌ Отменить", callback_data="cancel")
+    ]
+])
+
+# Только незахватывающие группы: результат нужен лишь как факт совпадения
+_YT_RE = re.compile(
+    r'(?:https?://)?(?:(?:www\.)?(?:youtube|youtu|youtube-nocookie)\.(?:com|be)|(?:m|gaming)\.youtube\.com)/',
+    re.I
+)
 
 def is_youtube_url(url: str) -> bool:
     """Проверка валидности YouTube URL"""
-    patterns = [
-        r'(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/',
-        r'(https?://)?youtu\.be/',
-        r'(https?://)?m\.youtube\.com/',
-        r'(https?://)?gaming\.youtube\.com/'
-    ]
-    return any(re.match(pattern, url) for pattern in patterns)
+    # Обычный текст отсекается по первому символу, без запуска regex
+    if not url or url[0].lower() not in 'hywmg':
+        return False
+    return _YT_RE.match(url) is not None
+
+_VIDEO_ID_RE = re.compile(r'(?:v=|youtu\.be/|shorts/)([A-Za-z0-9_-]{11})')
+
+def extract_video_id(url: str) -> str:
+    """Извлечение ID видео из URL (или сам URL, если ID не найден)"""
+    match = _VIDEO_ID_RE.search(url)
+    return match.group(1) if match else url
 
 def format_duration(seconds: int) -> str:
     """Форматирование длительности в читаемый вид"""
@@ -106,141 +348,315 @@ def format_duration(seconds: int) -> str:
         return escape_markdown_v2(f"{hours}ч {minutes}м")
     return escape_markdown_v2(f"{minutes}м")
 
+_SIZE_UNITS = ("B", "KB", "MB", "GB")
+
 def format_filesize(size_bytes: int) -> str:
     """Форматирование размера файла"""
-    if size_bytes == 0:
+    size_bytes = int(size_bytes or 0)
+    if size_bytes <= 0:
         return escape_markdown_v2("0 B")
-    size_names = ["B", "KB", "MB", "GB"]
-    i = int(math.floor(math.log(size_bytes, 1024)))
-    p = math.pow(1024, i)
-    s = round(size_bytes / p, 2)
-    return escape_markdown_v2(f"{s} {size_names[i]}")
-
-async def progress_hook(process: subprocess.Popen, status_msg_id: int, chat_id: int):
-    """Progress hook для yt-dlp с обновлением сообщения"""
-    while process.poll() is None:
-        try:
-            line = process.stdout.readline().strip()
-            if "download" in line.lower():
-                try:
-                    percent = float(line.split()[1].strip('%'))
-                    if percent % 10 == 0:  # Обновляем каждые 10%
-                        await rate_limiter.wait_if_needed()
-                        await bot.edit_message_text(
-                            chat_id=chat_id,
-                            message_id=status_msg_id,
-                            text=escape_markdown_v2(f"📥 Загружено: {percent:.1f}%"),
-                            parse_mode=ParseMode.MARKDOWN_V2
-                        )
-                except (IndexError, ValueError):
-                    pass
-        except Exception as e:
-            logger.error(f"Ошибка в progress_hook: {e}")
-        await asyncio.sleep(0.1)
+    # Порядок единицы по числу бит: каждые 10 бит — следующая единица
+    i = min((size_bytes.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    s = round(size_bytes / (1 << (i * 10)), 2)
+    return escape_markdown_v2(f"{s} {_SIZE_UNITS[i]}")
 
-def get_video_info(url: str) -> Optional[dict]:
-    """Получение информации о видео через subprocess"""
+# Общие параметры yt-dlp собираются один раз при загрузке модуля
+YTDLP_COMMON_ARGS = (
+    "--no-warnings",
+    "--ignore-errors",
+    # Ссылка вида watch?v=...&list=... не должна разворачиваться во весь плейлист
+    "--no-playlist",
+    # Адаптивные форматы YouTube как фрагменты DASH: иначе это один HTTP-поток,
+    # и --concurrent-fragments не действует. Параметр нужен уже при --dump-json,
+    # так как загрузка идёт по сохранённой информации (--load-info-json)
+    "--extractor-args", "youtube:formats=dashy",
+    "--user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "--sleep-requests", "1",
+    "--extractor-retries", "5",
+    "--socket-timeout", "30"
+)
+
+def build_ytdlp_cmd(*args: str) -> List[str]:
+    """Сборка команды yt-dlp с общими параметрами и cookies (источник — последним аргументом)"""
+    cmd = ["yt-dlp", *YTDLP_COMMON_ARGS]
+    if os.path.exists("cookies.txt"):
+        cmd.extend(["--cookies", "cookies.txt"])
+    cmd.extend(args)
+    return cmd
+
+def progress_hook(percent: float, status_msg_id: int, chat_id: int):
+    """Обновление сообщения с прогрессом загрузки"""
+    edit_coalescer.edit(chat_id, status_msg_id, escape_markdown_v2(f"📥 Загружено: {percent:.1f}%"))
+
+async def get_video_info(url: str) -> Optional[dict]:
+    """Получение информации о видео без блокировки event loop (с кэшем по ID)"""
+    video_id = extract_video_id(url)
+    if video_id in _info_cache:
+        return _info_cache[video_id]
+    # Одновременные запросы одного видео ждут единственный вызов yt-dlp
+    lock = _info_locks.setdefault(video_id, asyncio.Lock())
+    try:
+        async with lock:
+            video_info = _info_cache.get(video_id)
+            if video_info is None:
+                video_info = await fetch_video_info(url)
+                if video_info:
+                    # Субтитры и превью занимают большую часть JSON и нигде не используются
+                    for key in _INFO_UNUSED_KEYS:
+                        video_info.pop(key, None)
+                    _info_cache[video_id] = video_info
+            return video_info
+    finally:
+        if not lock.locked():
+            _info_locks.pop(video_id, None)
+
+async def fetch_video_info(url: str) -> Optional[dict]:
+    """Получение информации о видео через дочерний процесс yt-dlp, не блокируя event loop"""
     if not check_dependencies():
         return None
     
-    cmd = [
-        "yt-dlp",
-        "--dump-json",
-        "--no-warnings",
-        "--ignore-errors",
-        "--user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        "--sleep-requests", "1",
-        "--extractor-retries", "5",
-        "--socket-timeout", "30"
-    ]
-    if os.path.exists("cookies.txt"):
-        cmd.extend(["--cookies", "cookies.txt"])
-    cmd.append(url)
+    cmd = build_ytdlp_cmd("--dump-json", url)
     
     try:
-        result = subprocess.run(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            timeout=300
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
         )
-        if result.returncode != 0:
-            logger.error(f"Ошибка получения информации: {result.stderr.strip()}")
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=300)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            logger.error(f"Ошибка получения информации: {stderr.decode(errors='replace').strip()}")
             return None
-        data_json = json.loads(result.stdout.strip())
-        return data_json
-    except (subprocess.TimeoutExpired, json.JSONDecodeError, FileNotFoundError) as e:
+        return json.loads(stdout)
+    except (asyncio.TimeoutError, json.JSONDecodeError, FileNotFoundError) as e:
         logger.error(f"Ошибка получения информации: {e}")
         return None
 
-async def download_video(url: str, chat_id: int, status_msg_id: int) -> tuple[Optional[str], int]:
-    """Загрузка видео через subprocess"""
+def write_info_json(path: str, video_info: dict):
+    """Сохранение информации о видео для yt-dlp --load-info-json"""
+    with open(path, 'w', encoding='utf-8') as info_file:
+        json.dump(video_info, info_file)
+
+async def download_video(url: str, chat_id: int, status_msg_id: int,
+                         video_info: Optional[dict] = None) -> tuple[Optional[str], int]:
+    """Загрузка видео через дочерний процесс yt-dlp с чтением прогресса из его вывода"""
     if not check_dependencies():
         return None, 0
     
-    output_template = os.path.join(DOWNLOAD_DIR, f'video_{chat_id}_%(title)s.%(ext)s')
+    # У каждого чата свой каталог: файлы разных пользователей не пересекаются
+    chat_dir = os.path.join(DOWNLOAD_DIR, str(chat_id))
+    os.makedirs(chat_dir, exist_ok=True)
+    output_template = os.path.join(chat_dir, 'video_%(title)s.%(ext)s')
+    
+    # Уже полученная информация передаётся yt-dlp, чтобы не извлекать её повторно
+    info_path = None
+    source = [url]
+    if video_info:
+        info_path = os.path.join(chat_dir, f'info_{time.monotonic_ns()}.json')
+        # JSON со списком форматов занимает сотни КБ — пишется вне event loop
+        await asyncio.to_thread(write_info_json, info_path, video_info)
+        source = ["--load-info-json", info_path]
     
-    cmd = [
-        "yt-dlp",
+    cmd = build_ytdlp_cmd(
         "--output", output_template,
-        "--format", "bestvideo[height>=1080][height<=1440]+bestaudio/best[height>=1080][height<=1440]/best",
+        # Сначала MP4/M4A-потоки: их склейка в mp4 — простое копирование без перекодирования
+        "--format",
+        "bestvideo[ext=mp4][height>=1080][height<=1440]+bestaudio[ext=m4a]/"
+        "bestvideo[height>=1080][height<=1440]+bestaudio/best[height>=1080][height<=1440]/best",
         "--merge-output-format", "mp4",
-        "--no-warnings",
-        "--ignore-errors",
-        "--user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        "--sleep-requests", "1",
-        "--extractor-retries", "5",
-        "--socket-timeout", "30",
-        "--progress", "dot"
-    ]
-    if os.path.exists("cookies.txt"):
-        cmd.extend(["--cookies", "cookies.txt"])
-    cmd.append(url)
+        "--remux-video", "mp4",
+        "--concurrent-fragments", str(YTDLP_FRAGMENTS),
+        "--progress",
+        "--newline",
+        "--progress-template",
+        "download:[download] %(progress.downloaded_bytes)d %(progress.total_bytes,progress.total_bytes_estimate)d",
+        # Итоговый путь печатается последней строкой stdout
+        "--print", "after_move:filepath",
+        *source
+    )
+    
+    last_edit_ts = 0.0
+    last_bucket = -1
     
+    def on_line(line: str):
+        nonlocal last_edit_ts, last_bucket
+        if not line.startswith("[download] "):
+            return
+        # Правка не чаще раза в секунду: до этого строку даже не разбираем
+        now = time.monotonic()
+        if now - last_edit_ts < 1:
+            return
+        try:
+            downloaded, total = map(int, line.split()[1:3])
+        except ValueError:
+            return
+        if total <= 0:
+            return
+        # Шаги по 5% считаются целочисленно; правка — только при росте шага
+        # (у DASH-загрузки видео и звука прогресс начинается заново — он не откатывается)
+        bucket = min(downloaded * 20 // total, 20)
+        if bucket <= last_bucket:
+            return
+        last_edit_ts = now
+        last_bucket = bucket
+        # Правка отправляется в фоне, чтобы чтение вывода не ждало Telegram
+        progress_hook(bucket * 5, status_msg_id, chat_id)
+    
+    process = None
     try:
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        
-        asyncio.create_task(progress_hook(process, status_msg_id, chat_id))
-        
-        stdout, stderr = await process.communicate()
-        if process.returncode != 0:
-            logger.error(f"Ошибка загрузки: {stderr}")
+        async with _download_slots:
+            # stderr идёт в тот же поток: один канал читается построчно,
+            # а для сообщения об ошибке хранятся только последние строки
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT
+            )
+            tail = deque(maxlen=20)
+            # Путь печатается после переноса файла, но за ним ещё могут идти
+            # ERROR/WARNING из stderr — берётся последняя строка внутри каталога чата
+            path_prefix = os.path.join(chat_dir, '')
+            filepath = ""
+            async for raw_line in process.stdout:
+                line = raw_line.decode(errors='replace').strip()
+                if line:
+                    tail.append(line)
+                    if line.startswith(path_prefix):
+                        filepath = line
+                    else:
+                        on_line(line)
+            returncode = await process.wait()
+        if returncode != 0:
+            logger.error("Ошибка загрузки: " + "\n".join(tail))
             return None, 0
         
-        for file in os.listdir(DOWNLOAD_DIR):
-            if file.startswith(f'video_{chat_id}_') and file.endswith('.mp4'):
-                filepath = os.path.join(DOWNLOAD_DIR, file)
-                filesize = os.path.getsize(filepath)
-                return filepath, filesize
-        
-        return None, 0
+        # Один stat вместо отдельных isfile и getsize
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            logger.error(f"Загруженный файл не найден: {filepath}")
+            return None, 0
+        return filepath, st.st_size
     except Exception as e:
         logger.error(f"Ошибка загрузки: {e}")
         return None, 0
+    finally:
+        edit_coalescer.discard(chat_id, status_msg_id)
+        if process and process.returncode is None:
+            process.kill()
+        if info_path:
+            await asyncio.to_thread(cleanup_files, info_path)
+
+_MMAP_WINDOW = 64 * 1024 * 1024  # Окно отображения исходника в запасном варианте копирования
+_COPY_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTSOCK)
+
+def copy_range_mmap(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    """Запись диапазона прямо из отображения исходного файла в память, без промежуточных bytes"""
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    count = min(count, _MMAP_WINDOW)
+    with mmap.mmap(src_fd, offset - start + count, access=mmap.ACCESS_READ, offset=start) as mm:
+        with memoryview(mm) as view, view[offset - start:] as chunk:
+            return os.write(dst_fd, chunk)
+
+def copy_range(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    """Копирование диапазона байтов между файлами средствами ядра"""
+    if hasattr(os, 'copy_file_range'):
+        try:
+            # На одной ФС (btrfs/XFS) ядро может сделать reflink без копирования данных
+            return os.copy_file_range(src_fd, dst_fd, count, offset)
+        except OSError as e:
+            if e.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+    if hasattr(os, 'sendfile'):
+        try:
+            return os.sendfile(dst_fd, src_fd, offset, count)
+        except OSError as e:
+            # macOS и BSD умеют sendfile только в сокет
+            if e.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+    return copy_range_mmap(src_fd, dst_fd, offset, count)
+
+_FICLONERANGE = 0x4020940d  # ioctl Linux: reflink диапазона между файлами
 
-def split_file(filepath: str, chat_id: int) -> List[str]:
-    """Разделение файла на части"""
+def clone_range(src_fd: int, dst_fd: int, offset: int, length: int) -> bool:
+    """Reflink диапазона (btrfs/XFS): часть разделяет блоки с исходником, данные не копируются"""
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, _FICLONERANGE, struct.pack("qQQQ", src_fd, offset, length, 0))
+        return True
+    except OSError:
+        # ФС без reflink, другой раздел или невыровненный диапазон — обычное копирование
+        return False
+
+def copy_part(src_fd: int, part_filename: str, offset: int, length: int):
+    """Копирование одной части исходного файла в отдельный файл"""
+    start, size = offset, length
+    dst_fd = os.open(part_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if clone_range(src_fd, dst_fd, offset, length):
+            return
+        if hasattr(os, 'posix_fallocate'):
+            # Резервируем место под всю часть одной операцией
+            os.posix_fallocate(dst_fd, 0, length)
+        # Данные копируются в ядре, не поднимаясь в память процесса
+        while length:
+            copied = copy_range(src_fd, dst_fd, offset, length)
+            if not copied:
+                raise OSError(f"Неожиданный конец файла при копировании {part_filename}")
+            offset += copied
+            length -= copied
+        if hasattr(os, 'posix_fadvise'):
+            # Этот диапазон исходника больше не понадобится — освобождаем кэш страниц
+            os.posix_fadvise(src_fd, start, size, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(dst_fd)
+
+def split_file(filepath: str, chat_id: int, on_part: Optional[Callable[[int, int, str], None]] = None) -> List[str]:
+    """Разделение файла на части (исходный файл становится первой частью).
+
+    on_part(номер, всего, путь) вызывается сразу после готовности каждой части.
+    """
     parts = []
-    part_num = 1
-    base_name = os.path.splitext(os.path.basename(filepath))[0]
+    base_path = os.path.splitext(filepath)[0]
     
     try:
-        with open(filepath, "rb") as f:
-            while True:
-                chunk = f.read(int(CHUNK_SIZE))
-                if not chunk:
-                    break
-                part_filename = os.path.join(DOWNLOAD_DIR, f"{base_name}_part{part_num:02d}.mp4")
-                with open(part_filename, "wb") as part_file:
-                    part_file.write(chunk)
-                parts.append(part_filename)
-                part_num += 1
+        src_fd = os.open(filepath, os.O_RDONLY)
+        try:
+            filesize = os.fstat(src_fd).st_size
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            ranges = [(offset, min(CHUNK_SIZE, filesize - offset)) for offset in range(0, filesize, CHUNK_SIZE)]
+            parts = [
+                f"{base_path}_part{part_num:02d}.mp4"
+                for part_num in range(1, len(ranges) + 1)
+            ]
+            # Части не пересекаются, поэтому копируются параллельно: у диска
+            # остаётся несколько запросов в очереди вместо одного.
+            # Первая часть не копируется — ею станет сам исходный файл
+            with ThreadPoolExecutor(max_workers=min(SPLIT_WORKERS, len(ranges) or 1)) as pool:
+                futures = [
+                    pool.submit(copy_part, src_fd, part_filename, offset, length)
+                    for part_filename, (offset, length) in zip(parts[1:], ranges[1:])
+                ]
+                for part_num, future in enumerate(futures, 2):
+                    future.result()
+                    if on_part:
+                        on_part(part_num, len(parts), parts[part_num - 1])
+        finally:
+            os.close(src_fd)
+        # Обрезаем исходный файл до первой части и переименовываем его
+        os.truncate(filepath, ranges[0][1])
+        os.replace(filepath, parts[0])
+        if on_part:
+            on_part(1, len(parts), parts[0])
         logger.info(f"Файл разделен на {len(parts)} частей")
         return parts
     except Exception as e:
@@ -250,243 +666,447 @@ def split_file(filepath: str, chat_id: int) -> List[str]:
                 os.remove(part)
         return []
 
+async def _segment_paths(filepath: str, duration: float, recut: bool = True) -> AsyncGenerator[str, None]:
+    """Пути частей, нарезанных сегментным muxer ffmpeg без перекодирования, по мере готовности.
+
+    Сегмент, который из-за ключевых кадров и битрейта вышел больше CHUNK_SIZE,
+    один раз нарезается заново.
+    """
+    filesize = os.path.getsize(filepath)
+    # Части равны по времени; средний размер берётся с запасом 10% на неравномерный битрейт
+    total = max(2, -(-filesize * 10 // (CHUNK_SIZE * 9)))
+    # Округление вверх: последняя точка разреза не раньше конца видео и не даёт лишнего огрызка
+    segment_time = -(-int(duration * 1000) // total) / 1000
+    base_path = os.path.splitext(filepath)[0]
+    # % в названии видео ffmpeg принял бы за часть шаблона имени
+    pattern = f"{base_path.replace('%', '%%')}_part%02d.mp4"
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-v", "error", "-nostdin", "-i", filepath,
+        "-map", "0", "-c", "copy",
+        "-f", "segment", "-segment_time", f"{segment_time:.3f}",
+        "-reset_timestamps", "1", "-segment_start_number", "1",
+        # Имя каждого закрытого сегмента сразу печатается в stdout
+        "-segment_list", "pipe:1", "-segment_list_type", "flat",
+        pattern,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stderr_task = asyncio.create_task(process.stderr.read())
+    produced = 0
+    completed = False
+    try:
+        async for raw_line in process.stdout:
+            name = raw_line.decode(errors='replace').strip()
+            if not name:
+                continue
+            produced += 1
+            path = os.path.join(os.path.dirname(filepath), os.path.basename(name))
+            if os.path.getsize(path) <= CHUNK_SIZE:
+                yield path
+                continue
+            if not recut:
+                await asyncio.to_thread(cleanup_files, path)
+                raise RuntimeError(f"Сегмент {path} больше {CHUNK_SIZE} байт и после повторной нарезки")
+            logger.warning(f"Сегмент {path} больше лимита части, нарезаю его заново")
+            try:
+                async with aclosing(_segment_paths(path, segment_time, recut=False)) as sub_paths:
+                    async for sub_path in sub_paths:
+                        yield sub_path
+            finally:
+                await asyncio.to_thread(cleanup_files, path)
+        stderr = (await stderr_task).decode(errors='replace')
+        if await process.wait() != 0:
+            raise RuntimeError(f"ffmpeg завершился с ошибкой: {stderr.strip()}")
+        completed = True
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        stderr_task.cancel()
+        if not completed:
+            # ffmpeg пишет сегменты с опережением: всё, что ещё не отдано
+            # (и недописанный сегмент), иначе осталось бы на диске
+            await asyncio.to_thread(cleanup_segments, base_path, produced + 1)
+
+async def iter_segments(filepath: str, duration: float):
+    """Воспроизводимые части через ffmpeg: (номер, всего, путь).
+
+    Число частей известно только после разреза, поэтому каждая часть отдаётся,
+    когда ffmpeg закрыл следующую: у промежуточных частей в подписи оценка
+    «~N», у последней — точное число.
+    """
+    estimate = -(-os.path.getsize(filepath) * 10 // (CHUNK_SIZE * 9))
+    produced = 0
+    pending = None
+    try:
+        async with aclosing(_segment_paths(filepath, duration)) as paths:
+            async for path in paths:
+                ready, pending = pending, path
+                if ready:
+                    produced += 1
+                    yield produced, f"~{max(estimate, produced + 1)}", ready
+    except BaseException:
+        # Придержанная часть никому не отдана — удаляем её сами
+        if pending:
+            await asyncio.to_thread(cleanup_files, pending)
+        raise
+    if pending:
+        produced += 1
+        yield produced, produced, pending
+
+async def iter_parts(filepath: str, chat_id: int, duration: float = 0):
+    """Части файла по мере готовности: (номер, всего, путь или диапазон файла).
+
+    При известной длительности ffmpeg режет видео на воспроизводимые части.
+    Иначе файл делится по байтам: части отправляются как диапазоны исходника,
+    а для локального Bot API копируются в файлы — первая часть тогда приходит
+    последней, так как ею становится сам исходный файл.
+    """
+    if duration:
+        produced = 0
+        try:
+            async with aclosing(iter_segments(filepath, duration)) as segments:
+                async for item in segments:
+                    produced += 1
+                    yield item
+        except Exception as e:
+            if produced:
+                raise
+            logger.warning(f"Не удалось разделить видео через ffmpeg, делю по байтам: {e}")
+        else:
+            await asyncio.to_thread(cleanup_files, filepath)
+            return
+
+    if not TELEGRAM_API_LOCAL:
+        # Части — диапазоны исходного файла: они читаются при отправке, без копий на диске
+        filesize = os.path.getsize(filepath)
+        base_name = os.path.splitext(os.path.basename(filepath))[0]
+        total = -(-filesize // CHUNK_SIZE)
+        for part_num, offset in enumerate(range(0, filesize, CHUNK_SIZE), 1):
+            yield part_num, total, FileRangeInputFile(
+                filepath, offset, min(CHUNK_SIZE, filesize - offset),
+                filename=f"{base_name}_part{part_num:02d}.mp4"
+            )
+        return
+
+    # Локальному серверу Bot API нужны настоящие файлы
+    loop = asyncio.get_running_loop()
+    ready: asyncio.Queue = asyncio.Queue()
+    split_task = asyncio.ensure_future(asyncio.to_thread(
+        split_file, filepath, chat_id,
+        lambda *item: loop.call_soon_threadsafe(ready.put_nowait, item)
+    ))
+    split_task.add_done_callback(lambda _: ready.put_nowait(None))
+    while (item := await ready.get()) is not None:
+        yield item
+    if not await split_task:
+        raise OSError(f"Не удалось разделить файл {filepath}")
+
+def cleanup_segments(base_path: str, start: int):
+    """Удаление сегментов ffmpeg {base_path}_partNN.mp4 начиная с номера start (до первого отсутствующего)"""
+    part_num = start
+    while True:
+        path = f"{base_path}_part{part_num:02d}.mp4"
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Ошибка удаления файла {path}: {e}")
+        else:
+            logger.info(f"Удален файл: {path}")
+        part_num += 1
+
 def cleanup_files(*filepaths: str):
     """Безопасная очистка файлов"""
     for filepath in filepaths:
+        if not filepath:
+            continue
         try:
-            if filepath and os.path.exists(filepath):
-                os.remove(filepath)
-                logger.info(f"Удален файл: {filepath}")
+            # Один системный вызов без предварительной проверки существования
+            os.unlink(filepath)
+            logger.info(f"Удален файл: {filepath}")
+        except FileNotFoundError:
+            pass
         except Exception as e:
             logger.error(f"Ошибка удаления файла {filepath}: {e}")
 
+class FileRangeInputFile(types.InputFile):
+    """Диапазон файла для отправки: часть читается прямо из исходника"""
+
+    def __init__(self, path: str, offset: int, length: int, filename: str,
+                 chunk_size: int = UPLOAD_CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        async with aiofiles.open(self.path, 'rb') as f:
+            await f.seek(self.offset)
+            remaining = self.length
+            while remaining:
+                chunk = await f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+def upload_file(path: str) -> Union[str, types.FSInputFile]:
+    """Файл для отправки: aiogram читает его через aiofiles крупными блоками вне event loop"""
+    if TELEGRAM_API_LOCAL:
+        # Локальный сервер читает файл с диска сам
+        return f"file://{os.path.abspath(path)}"
+    return types.FSInputFile(path, filename=os.path.basename(path), chunk_size=UPLOAD_CHUNK_SIZE)
+
+async def send_part(chat_id: int, part: Union[str, types.InputFile], i: int, total: Union[int, str],
+                    semaphore: asyncio.Semaphore):
+    """Отправка одной части видео (с запасным вариантом в виде документа) и удаление её файла"""
+    upload = upload_file(part) if isinstance(part, str) else part
+    try:
+        async with semaphore, rate_limiter.chat_slots(chat_id):
+            try:
+                await bot.send_video(
+                    chat_id=chat_id,
+                    video=upload,
+                    caption=escape_markdown_v2(f"🎥 Часть {i} из {total}"),
+                    parse_mode=ParseMode.MARKDOWN_V2,
+                    request_timeout=UPLOAD_TIMEOUT
+                )
+            except Exception as e:
+                logger.error(f"Ошибка отправки части {i}: {e}")
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text=escape_markdown_v2(f"❌ Ошибка отправки части {i}."),
+                    parse_mode=ParseMode.MARKDOWN_V2
+                )
+                # Fallback: отправка как документ
+                try:
+                    await bot.send_document(
+                        chat_id=chat_id,
+                        document=upload,
+                        caption=escape_markdown_v2(f"🎥 Часть {i} из {total} (документ)"),
+                        parse_mode=ParseMode.MARKDOWN_V2,
+                        request_timeout=UPLOAD_TIMEOUT
+                    )
+                except Exception as e2:
+                    logger.error(f"Ошибка отправки части {i} как документа: {e2}")
+    finally:
+        if isinstance(part, str):
+            # Часть больше не нужна — освобождаем место, пока готовятся остальные
+            await asyncio.to_thread(cleanup_files, part)
+
+async def reset_state(state: FSMContext):
+    """Сброс данных загрузки и возврат к ожиданию ссылки"""
+    await state.set_data({})
+    await state.set_state(VideoStates.waiting_for_url)
+
 @dp.message(Command("start"))
 async def start(message: types.Message, state: FSMContext):
     """Команда /start"""
-    await rate_limiter.wait_if_needed()
-    welcome_text = escape_markdown_v2(
-        "🎬 *YouTube Downloader Bot*\n\n"
-        "📋 *Возможности:*\n"
-        "• Скачивание видео в 1080p–2K качестве\n"
-        "• Поддержка длинных видео (2+ часа)\n"
-        "• Автоматическое разделение больших файлов\n\n"
-        "📝 *Как использовать:*\n"
-        "Отправьте ссылку на YouTube видео или используйте команды:\n"
-        "/start - Начать работу\n"
-        "/help - Показать справку"
-    )
-    await message.reply(welcome_text, parse_mode=ParseMode.MARKDOWN_V2)
+    await message.reply(_WELCOME_TEXT, parse_mode=ParseMode.MARKDOWN_V2)
     await state.set_state(VideoStates.waiting_for_url)
 
 @dp.message(Command("help"))
 async def help_cmd(message: types.Message):
     """Команда /help"""
-    await rate_limiter.wait_if_needed()
-    help_text = escape_markdown_v2(
-        "🆘 *Помощь*\n\n"
-        "*Команды:*\n"
-        "/start - Запуск бота\n"
-        "/help - Эта справка\n\n"
-        "*Как скачать видео:*\n"
-        "Отправьте ссылку на YouTube видео. Видео будет загружено в 1080p–2K качестве. Если размер превысит 2 ГБ, бот предложит разделить файл.\n\n"
-        "*Поддерживаемые форматы ссылок:*\n"
-        "• youtube.com/watch?v=...\n"
-        "• youtu.be/...\n"
-        "• m.youtube.com/..."
-    )
-    await message.reply(help_text, parse_mode=ParseMode.MARKDOWN_V2)
+    await message.reply(_HELP_TEXT, parse_mode=ParseMode.MARKDOWN_V2)
 
-@dp.message(VideoStates.waiting_for_url)
+# Только текстовые сообщения: у стикеров и фото нет message.text
+@dp.message(VideoStates.waiting_for_url, F.text)
 async def handle_message(message: types.Message, state: FSMContext):
     """Обработка YouTube URL"""
     url = message.text.strip()
     if not is_youtube_url(url):
-        await rate_limiter.wait_if_needed()
         await message.reply(
             escape_markdown_v2("❌ Пожалуйста, отправьте корректную ссылку на YouTube видео."),
             parse_mode=ParseMode.MARKDOWN_V2
         )
         return
     
-    await rate_limiter.wait_if_needed()
     status_msg = await message.reply(
         escape_markdown_v2("🔍 Проверяю видео..."),
         parse_mode=ParseMode.MARKDOWN_V2
     )
     
     if not check_dependencies():
-        await rate_limiter.wait_if_needed()
-        await bot.edit_message_text(
+        await edit_status(
             chat_id=message.chat.id,
             message_id=status_msg.message_id,
-            text=escape_markdown_v2("❌ Ошибка: yt-dlp или ffmpeg не установлены. Установите их и добавьте в PATH."),
-            parse_mode=ParseMode.MARKDOWN_V2
+            text=escape_markdown_v2("❌ Ошибка: yt-dlp или ffmpeg не установлены. Установите их и добавьте в PATH.")
         )
         return
     
-    video_info = get_video_info(url)
+    video_info = await get_video_info(url)
     if not video_info:
-        await rate_limiter.wait_if_needed()
-        await bot.edit_message_text(
+        await edit_status(
             chat_id=message.chat.id,
             message_id=status_msg.message_id,
-            text=escape_markdown_v2("❌ Не удалось получить информацию о видео. Попробуйте другую ссылку или проверьте cookies.txt."),
-            parse_mode=ParseMode.MARKDOWN_V2
+            text=escape_markdown_v2("❌ Не удалось получить информацию о видео. Попробуйте другую ссылку или проверьте cookies.txt.")
         )
         return
     
     title = video_info.get('title', 'Неизвестное видео')
     duration = video_info.get('duration', 0)
     filesize_approx = video_info.get('filesize_approx', 0)
+    if filesize_approx and shutil.disk_usage(DOWNLOAD_DIR).free < filesize_approx * DISK_HEADROOM:
+        logger.warning(f"Недостаточно места для загрузки {url}: нужно ~{filesize_approx * DISK_HEADROOM:.0f} байт")
+        await edit_status(
+            chat_id=message.chat.id,
+            message_id=status_msg.message_id,
+            text=escape_markdown_v2("❌ Недостаточно места на сервере. Попробуйте позже.")
+        )
+        return
     
-    await rate_limiter.wait_if_needed()
-    await bot.edit_message_text(
+    # Название экранируется один раз: разметка вокруг него уже готова для MarkdownV2
+    safe_title = escape_markdown_v2(title)
+    
+    await edit_status(
         chat_id=message.chat.id,
         message_id=status_msg.message_id,
-        text=escape_markdown_v2(
-            f"📹 *Название:* {title}\n"
+        text=(
+            f"📹 *Название:* {safe_title}\n"
             f"⏱ *Длительность:* {format_duration(duration)}\n"
             f"📦 *Примерный размер:* {format_filesize(filesize_approx)}\n\n"
-            "📥 Начинаю загрузку..."
-        ),
-        parse_mode=ParseMode.MARKDOWN_V2
+            "📥 Начинаю загрузку\\.\\.\\."
+        )
     )
     
-    filepath, filesize = await download_video(url, message.chat.id, status_msg.message_id)
+    filepath, filesize = await download_video(url, message.chat.id, status_msg.message_id, video_info)
     if not filepath:
-        await rate_limiter.wait_if_needed()
-        await bot.edit_message_text(
+        await edit_status(
             chat_id=message.chat.id,
             message_id=status_msg.message_id,
-            text=escape_markdown_v2("❌ Ошибка загрузки видео. Попробуйте позже или другую ссылку."),
-            parse_mode=ParseMode.MARKDOWN_V2
+            text=escape_markdown_v2("❌ Ошибка загрузки видео. Попробуйте позже или другую ссылку.")
         )
         return
     
     if filesize <= MAX_FILE_SIZE:
-        await rate_limiter.wait_if_needed()
         try:
-            with open(filepath, 'rb') as video_file:
-                await message.reply_video(
-                    video=types.FSInputFile(filepath),
-                    caption=escape_markdown_v2(f"🎥 {title}"),
-                    parse_mode=ParseMode.MARKDOWN_V2,
-                    duration=duration if duration else None
-                )
-            cleanup_files(filepath)
+            await bot(message.reply_video(
+                video=upload_file(filepath),
+                caption=f"🎥 {safe_title}",
+                parse_mode=ParseMode.MARKDOWN_V2,
+                duration=duration if duration else None
+            ), request_timeout=UPLOAD_TIMEOUT)
+            await asyncio.to_thread(cleanup_files, filepath)
             await bot.delete_message(message.chat.id, status_msg.message_id)
         except Exception as e:
             logger.error(f"Ошибка отправки видео: {e}")
-            await bot.edit_message_text(
+            await edit_status(
                 chat_id=message.chat.id,
                 message_id=status_msg.message_id,
-                text=escape_markdown_v2("❌ Ошибка отправки видео. Попробуйте позже."),
-                parse_mode=ParseMode.MARKDOWN_V2
+                text=escape_markdown_v2("❌ Ошибка отправки видео. Попробуйте позже.")
             )
-            cleanup_files(filepath)
+            await asyncio.to_thread(cleanup_files, filepath)
         return
     
-    await rate_limiter.wait_if_needed()
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="✅ Разделить", callback_data=f"split_{filepath}"),
-            InlineKeyboardButton(text="❌ Отменить", callback_data="cancel")
-        ]
-    ])
-    await bot.edit_message_text(
+    await edit_status(
         chat_id=message.chat.id,
         message_id=status_msg.message_id,
-        text=escape_markdown_v2(
-            f"⚠️ Видео слишком большое ({format_filesize(filesize)}). Хотите разделить на части?"
+        text=(
+            f"⚠️ Видео слишком большое \\({format_filesize(filesize)}\\)\\. Хотите разделить на части?"
         ),
-        reply_markup=keyboard,
-        parse_mode=ParseMode.MARKDOWN_V2
+        reply_markup=_SPLIT_KEYBOARD
     )
     await state.set_state(VideoStates.waiting_for_split)
-    await state.update_data(filepath=filepath, original_message_id=message.message_id)
+    await state.update_data(filepath=filepath, title=title, duration=duration,
+                            original_message_id=message.message_id)
 
-@dp.callback_query()
+# Файлы, которые сейчас разделяются и отправляются
+_active_splits: set[str] = set()
+_SPLIT_BUSY_TEXT = "⏳ Видео уже разделяется и отправляется."
+
+@dp.callback_query(VideoStates.waiting_for_split)
 async def handle_callback(query: types.CallbackQuery, state: FSMContext):
     """Обработка callback для разделения"""
     chat_id = query.message.chat.id
     message_id = query.message.message_id
+    # Путь к файлу хранится только в состоянии: в callback_data он мог бы не уместиться
+    data = await state.get_data()
+    filepath = data.get('filepath')
+    # Нажатия из одной пачки обновлений проходят фильтр состояния одновременно:
+    # проверка и отметка файла идут без await между ними
+    if filepath in _active_splits:
+        await query.answer(_SPLIT_BUSY_TEXT)
+        return
+    # Состояние меняется до любых запросов к Telegram: повторное нажатие
+    # не должно запустить вторую обработку того же файла
+    if query.data == "split":
+        if filepath:
+            _active_splits.add(filepath)
+        await state.set_state(VideoStates.splitting)
+    else:
+        await reset_state(state)
     await query.answer()
     
-    await rate_limiter.wait_if_needed()
     if query.data == "cancel":
-        data = await state.get_data()
-        filepath = data.get('filepath')
-        cleanup_files(filepath)
-        await bot.edit_message_text(
+        await asyncio.to_thread(cleanup_files, filepath)
+        await edit_status(
             chat_id=chat_id,
             message_id=message_id,
-            text=escape_markdown_v2("❌ Загрузка отменена. Файл удалён."),
-            parse_mode=ParseMode.MARKDOWN_V2
-        )
-        await state.clear()
-    elif query.data.startswith("split_"):
-        filepath = query.data[len("split_"):]
-        if not os.path.exists(filepath):
-            await bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=message_id,
-                text=escape_markdown_v2("❌ Файл не найден. Попробуйте загрузить видео заново."),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            await state.clear()
-            return
-        
-        await bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=message_id,
-            text=escape_markdown_v2("✂️ Разделяю видео на части..."),
-            parse_mode=ParseMode.MARKDOWN_V2
+            text=escape_markdown_v2("❌ Загрузка отменена. Файл удалён.")
         )
+    elif query.data == "split":
+        try:
+            if not filepath or not os.path.exists(filepath):
+                await edit_status(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text=escape_markdown_v2("❌ Файл не найден. Попробуйте загрузить видео заново.")
+                )
+                return
         
-        parts = split_file(filepath, chat_id)
-        if not parts:
-            cleanup_files(filepath)
-            await bot.edit_message_text(
+            await edit_status(
                 chat_id=chat_id,
                 message_id=message_id,
-                text=escape_markdown_v2("❌ Ошибка при разделении видео. Попробуйте позже."),
-                parse_mode=ParseMode.MARKDOWN_V2
+                text=escape_markdown_v2("✂️ Разделяю видео на части...")
             )
-            await state.clear()
-            return
         
-        await rate_limiter.wait_if_needed()
-        for i, part in enumerate(parts, 1):
+            # Каждая часть отправляется, как только готова, но не более
+            # MAX_PARALLEL_UPLOADS одновременно
+            semaphore = asyncio.Semaphore(MAX_PARALLEL_UPLOADS)
+            uploads = []
+            split_failed = False
+            duration = data.get('duration') or 0
             try:
-                with open(part, 'rb') as part_file:
-                    await bot.send_video(
-                        chat_id=chat_id,
-                        video=types.FSInputFile(part),
-                        caption=escape_markdown_v2(f"🎥 Часть {i} из {len(parts)}"),
-                        parse_mode=ParseMode.MARKDOWN_V2
-                    )
+                async with aclosing(iter_parts(filepath, chat_id, duration)) as parts:
+                    async for i, total, part in parts:
+                        uploads.append(asyncio.create_task(send_part(chat_id, part, i, total, semaphore)))
             except Exception as e:
-                logger.error(f"Ошибка отправки части {i}: {e}")
-                await bot.send_message(
+                logger.error(f"Ошибка разделения видео: {e}")
+                split_failed = True
+            results = await asyncio.gather(*uploads, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"Ошибка отправки части: {result}")
+            # Исходник, если он ещё остался (части-диапазоны читались прямо из него)
+            await asyncio.to_thread(cleanup_files, filepath)
+
+            if split_failed or not uploads:
+                await edit_status(
                     chat_id=chat_id,
-                    text=escape_markdown_v2(f"❌ Ошибка отправки части {i}."),
-                    parse_mode=ParseMode.MARKDOWN_V2
+                    message_id=message_id,
+                    text=escape_markdown_v2("❌ Ошибка при разделении видео. Попробуйте позже.")
                 )
-                # Fallback: отправка как документ
-                try:
-                    with open(part, 'rb') as part_file:
-                        await bot.send_document(
-                            chat_id=chat_id,
-                            document=types.FSInputFile(part),
-                            caption=escape_markdown_v2(f"🎥 Часть {i} из {len(parts)} (документ)"),
-                            parse_mode=ParseMode.MARKDOWN_V2
-                        )
-                except Exception as e2:
-                    logger.error(f"Ошибка отправки части {i} как документа: {e2}")
+                return
 
-        cleanup_files(filepath, *parts)
-        await bot.delete_message(chat_id, message_id)
-        await state.clear()
+            await bot.delete_message(chat_id, message_id)
+        finally:
+            _active_splits.discard(filepath)
+            # За время отправки пользователь мог начать новую загрузку — её состояние не трогаем
+            if await state.get_state() == VideoStates.splitting.state:
+                await reset_state(state)
+
+@dp.callback_query(VideoStates.splitting)
+async def handle_callback_while_splitting(query: types.CallbackQuery):
+    """Нажатие кнопки, пока видео уже разделяется"""
+    await query.answer(_SPLIT_BUSY_TEXT)
+
+@dp.callback_query()
+async def handle_stale_callback(query: types.CallbackQuery):
+    """Кнопки старых сообщений: файл уже удалён или бот был перезапущен"""
+    await query.answer("❌ Файл больше недоступен. Отправьте ссылку заново.", show_alert=True)
 
 async def set_bot_commands():
     """Устанавливаем команды в меню бота"""
@@ -497,7 +1117,49 @@ async def set_bot_commands():
     await bot.set_my_commands(commands)
     logger.info("Команды меню установлены")
 
-async def main():
+async def on_startup():
+    """Подготовка бота перед приёмом обновлений"""
+    global rate_limiter
+    rate_limiter = TelegramRateLimiter()
+    await set_bot_commands()
+    # Накопившиеся обновления отбрасываются на стороне Telegram
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=True,
+            secret_token=WEBHOOK_SECRET
+        )
+        logger.info(f"Webhook установлен: {WEBHOOK_URL}{WEBHOOK_PATH}")
+        if not WEBHOOK_SECRET:
+            logger.warning("WEBHOOK_SECRET не задан: webhook принимает обновления без проверки отправителя")
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+
+async def on_shutdown():
+    """Закрытие HTTP-сессии бота, хранилища состояний и удаление временного каталога загрузок"""
+    await session.close()
+    logger.info("Сессия бота закрыта")
+    await storage.close()
+    if not os.getenv('DOWNLOAD_DIR'):
+        await asyncio.to_thread(shutil.rmtree, DOWNLOAD_DIR, ignore_errors=True)
+        logger.info(f"Удален каталог загрузок: {DOWNLOAD_DIR}")
+
+async def run_webhook():
+    """Приём обновлений через webhook на aiohttp-сервере в общем event loop"""
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()  # Вызывает startup-хуки диспетчера
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    logger.info(f"Webhook-сервер слушает порт {PORT}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()  # Вызывает shutdown-хуки диспетчера
+
+def main():
     """Главная функция"""
     if not TELEGRAM_TOKEN:
         logger.error("❌ ОШИБКА: Токен бота не найден в переменной окружения TELEGRAM_TOKEN")
@@ -507,13 +1169,21 @@ async def main():
         logger.error("❌ ОШИБКА: Не установлены yt-dlp или ffmpeg. Установите их и добавьте в PATH.")
         return
     
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
     try:
-        global rate_limiter
-        rate_limiter = TelegramRateLimiter()
-        await set_bot_commands()
-        await dp.start_polling(bot, skip_updates=True)
+        if WEBHOOK_URL:
+            asyncio.run(run_webhook())
+        else:
+            asyncio.run(dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES))
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        # uvloop нет под Windows — работаем на стандартном event loop
+        logger.info("uvloop не установлен, используется стандартный event loop")
+    main()